@@ -1,11 +1,22 @@
+import atexit
+import csv
+import io
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 from functools import wraps
 from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify
+from cachetools import TTLCache
+from flask_caching import Cache
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from bson import ObjectId
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
 from dotenv import load_dotenv
 
 
@@ -34,16 +45,40 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")  # optional convenience for first-run
 ADMIN_PASSWORD_HASH = os.getenv("ADMIN_PASSWORD_HASH")  # optional pre-hash
+REDIS_URL = os.getenv("REDIS_URL")  # shared cache; required with more than one worker/instance
 
 # --- Flask / DB setup ---
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
-client = MongoClient(MONGO_URI)
+cache = Cache(app, config={
+    "CACHE_TYPE": "RedisCache" if REDIS_URL else "SimpleCache",
+    "CACHE_REDIS_URL": REDIS_URL,
+    "CACHE_DEFAULT_TIMEOUT": 60
+})
+if not REDIS_URL:
+    # SimpleCache lives in one process, so a write only clears that worker's copy
+    print("WARNING: REDIS_URL not set, using a per-process cache. With several workers "
+          "or instances, dashboard/summary stats can lag writes by up to 60 seconds "
+          "and the class list by up to 5 minutes.")
+
+# One client (and connection pool) per process; zstd falls back to zlib if not installed
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=5,
+    compressors="zstd,zlib",
+    retryWrites=True,
+    w="majority",
+    readPreference="primaryPreferred",
+    serverSelectionTimeoutMS=5000
+)
 db = client.bright_horizon
 students_col = db.students
 admins_col = db.admins
 logs_col = db.logs
+payments_col = db.payments  # one document per payment, keyed by student_id
+meta_col = db.meta  # one document per finished data migration
 
 login_manager = LoginManager()
 login_manager.login_view = "login"
@@ -56,15 +91,28 @@ class AdminUser(UserMixin):
         self.username = admin_doc.get("username")
 
 
+# Per-process cache so authenticated requests don't each cost an admins lookup.
+# Admins aren't edited through the app, so a removed one just expires after 5 minutes.
+_user_cache = TTLCache(maxsize=128, ttl=300)
+_user_cache_lock = threading.Lock()
+
+
 @login_manager.user_loader
 def load_user(user_id):
+    with _user_cache_lock:
+        user = _user_cache.get(user_id)
+    if user:
+        return user
     try:
         admin_doc = admins_col.find_one({"_id": ObjectId(user_id)})
     except:
         return None
     if not admin_doc:
         return None
-    return AdminUser(admin_doc)
+    user = AdminUser(admin_doc)
+    with _user_cache_lock:
+        _user_cache[user_id] = user
+    return user
 
 
 @login_manager.unauthorized_handler
@@ -73,13 +121,34 @@ def unauthorized():
     return redirect(url_for("login"))
 
 
+# Argon2id (OWASP's minimum profile); Werkzeug PBKDF2 hashes are still
+# accepted and upgraded on the next successful login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+
+def verify_password(admin, password):
+    pw_hash = admin["password_hash"]
+    if pw_hash.startswith("$argon2"):
+        try:
+            password_hasher.verify(pw_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(pw_hash):
+            return True
+    elif not check_password_hash(pw_hash, password):
+        return False
+    admins_col.update_one({"_id": admin["_id"]},
+                          {"$set": {"password_hash": password_hasher.hash(password)}})
+    return True
+
+
 def ensure_admin():
     """On first run: if no admin exists, create one from env var."""
-    if admins_col.count_documents({}) == 0:
+    if admins_col.estimated_document_count() == 0:
         if ADMIN_PASSWORD_HASH:
             pw_hash = ADMIN_PASSWORD_HASH
         elif ADMIN_PASSWORD:
-            pw_hash = generate_password_hash(ADMIN_PASSWORD)
+            pw_hash = password_hasher.hash(ADMIN_PASSWORD)
         else:
             print("WARNING: No admin credentials provided! Set ADMIN_PASSWORD or ADMIN_PASSWORD_HASH env var.")
             return
@@ -94,6 +163,102 @@ def ensure_admin():
 ensure_admin()
 
 
+def ensure_indexes():
+    """Create the indexes the routes rely on (no-op if they already exist)."""
+    indexes = [
+        (admins_col, "username", {"unique": True}),
+        (students_col, [("created_at", -1)], {}),
+        (payments_col, [("student_id", 1), ("date", -1)], {}),
+        (logs_col, [("at", -1)], {}),
+    ]
+    # one at a time, so a failing index (e.g. duplicate usernames) doesn't skip the rest
+    for col, keys, options in indexes:
+        try:
+            col.create_index(keys, **options)
+        except PyMongoError as e:
+            print(f"WARNING: Could not create index {keys} on {col.name}: {e}")
+
+
+ensure_indexes()
+
+
+def ensure_unique_student_index():
+    """
+    Reject duplicate students (same normalized name + same class) with a unique index.
+    Returns False if existing duplicates prevent building it, in which case the
+    add/edit routes fall back to checking with find_one first.
+    """
+    try:
+        existing = students_col.index_information()
+        # Class filter + name sort on the list page (may already be the unique one)
+        if "class_1_name_1" not in existing:
+            students_col.create_index([("class", 1), ("name", 1)])
+        elif existing["class_1_name_1"].get("unique"):
+            return True
+        # Same fields in the other order, since Mongo won't keep a unique and a
+        # non-unique index on one key pattern
+        students_col.create_index([("name", 1), ("class", 1)], unique=True)
+        return True
+    except PyMongoError as e:
+        print(f"WARNING: Could not create unique name/class index, duplicate checks fall back to queries: {e}")
+        return False
+
+
+UNIQUE_STUDENT_INDEX = ensure_unique_student_index()
+
+
+def run_migration(name, migrate):
+    """Run a one-off data migration unless an earlier start already finished it."""
+    if meta_col.find_one({"_id": name}):
+        return
+    migrate()
+    meta_col.update_one({"_id": name}, {"$set": {"done_at": datetime.utcnow()}}, upsert=True)
+
+
+def backfill_paid_total():
+    """Store the running payments sum on students created before `paid_total` existed."""
+    students_col.update_many(
+        {"paid_total": {"$exists": False}},
+        [{"$set": {"paid_total": {"$sum": "$payments.amount"}}}]
+    )
+
+
+run_migration("backfill_paid_total", backfill_paid_total)
+
+
+def migrate_embedded_payments():
+    """Move payments still embedded on student documents into the payments collection."""
+    for s in students_col.find({"payments.0": {"$exists": True}}, {"payments": 1}):
+        # Ids derived from student + position make reruns and parallel workers
+        # collide on duplicate keys instead of copying a payment twice
+        docs = [dict(p, _id=f"{s['_id']}:{i}", student_id=s["_id"])
+                for i, p in enumerate(s["payments"])]
+        try:
+            payments_col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                raise
+        # only drop the embedded copy once every payment is known to be stored
+        students_col.update_one({"_id": s["_id"]}, {"$unset": {"payments": ""}})
+    # students that never had a payment still carry an empty array
+    students_col.update_many({"payments": {"$exists": True}}, {"$unset": {"payments": ""}})
+
+
+run_migration("migrate_embedded_payments", migrate_embedded_payments)
+
+
+def drop_unused_indexes():
+    """Remove indexes earlier versions created that no query uses (they only slow down writes)."""
+    for name in ("class_1_total_fee_1", "class_1_paid_total_1", "total_fee_1"):
+        try:
+            students_col.drop_index(name)
+        except PyMongoError:
+            pass  # never created here
+
+
+run_migration("drop_unused_indexes", drop_unused_indexes)
+
+
 def admin_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -103,20 +268,140 @@ def admin_required(f):
     return wrapper
 
 
+def _oid(sid):
+    """Parse a student id from the URL, 404 on malformed ids instead of a 500."""
+    if not ObjectId.is_valid(sid):
+        abort(404)
+    return ObjectId(sid)
+
+
 def calc_unpaid(student):
-    total_fee = student.get("total_fee", 0)
-    payments = student.get("payments", [])
-    received = sum(p.get("amount", 0) for p in payments)
-    return total_fee - received
+    return student.get("total_fee", 0) - student.get("paid_total", 0)
+
+
+# Per-class fee totals, computed server-side in a single round-trip
+CLASS_STATS_PIPELINE = [
+    {"$group": {
+        "_id": "$class",
+        "class_total": {"$sum": "$total_fee"},
+        "collected": {"$sum": "$paid_total"},
+        "students_count": {"$sum": 1}
+    }},
+    {"$sort": {"_id": 1}}
+]
+
+
+# Stats are cached as data (not rendered pages) so flashed messages never end up in the cache
+@cache.memoize(timeout=60)
+def get_class_stats():
+    return list(students_col.aggregate(CLASS_STATS_PIPELINE))
+
+
+@cache.memoize(timeout=60)
+def get_summary_stats():
+    # All three summary figures in one pass over the collection
+    pipeline = [
+        {"$facet": {
+            "total": [{"$count": "n"}],
+            # Class-wise counts
+            "by_class": [
+                {"$group": {"_id": "$class", "count": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ],
+            # Free students (monthly_fee = 0)
+            "free": [{"$match": {"total_fee": 0}}, {"$count": "n"}]
+        }}
+    ]
+    result = next(students_col.aggregate(pipeline))
+    # $count emits no document at all when nothing matches
+    return {
+        "total_students": result["total"][0]["n"] if result["total"] else 0,
+        "class_counts": result["by_class"],
+        "free_students": result["free"][0]["n"] if result["free"] else 0
+    }
+
+
+@cache.memoize(timeout=300)
+def get_classes():
+    return students_col.distinct("class")
+
+
+def invalidate_stats():
+    """Drop cached stats after a write so dashboards show it immediately."""
+    cache.delete_memoized(get_classes)
+    cache.delete_memoized(get_class_stats)
+    cache.delete_memoized(get_summary_stats)
+
+
+# Audit logs are queued and written in batches by a background thread,
+# so write routes don't wait on an extra insert. Vercel freezes the function
+# after each response (and skips atexit), so there they are written inline.
+LOG_SYNC = bool(os.getenv("VERCEL") or os.getenv("LOG_SYNC"))
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 1.0  # seconds
+_log_queue = queue.Queue()
+
+
+def _write_logs(batch):
+    try:
+        logs_col.insert_many(batch, ordered=False)
+    # anything escaping here would kill the writer thread and leave the queue growing
+    except Exception as e:
+        print(f"WARNING: Could not write {len(batch)} log entries: {e}")
+
+
+def _log_writer():
+    while True:
+        batch = [_log_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_logs(batch)
+
+
+def flush_logs():
+    """Write whatever is still queued (used on shutdown)."""
+    batch = []
+    while True:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _write_logs(batch)
+
+
+def start_log_writer():
+    if LOG_SYNC:
+        return
+    threading.Thread(target=_log_writer, name="log-writer", daemon=True).start()
+    atexit.register(flush_logs)
+
+
+start_log_writer()
 
 
 def log_action(act, details):
-    logs_col.insert_one({
+    entry = {
         "action": act,
         "details": details,
         "by": current_user.username if current_user.is_authenticated else "system",
         "at": datetime.utcnow()
-    })
+    }
+    if LOG_SYNC:
+        _write_logs([entry])
+    else:
+        _log_queue.put_nowait(entry)
+
+
+# List pages hand cursors straight to the templates; this is the per-fetch batch size
+LIST_BATCH_SIZE = 100
 
 
 # --- Routes ---
@@ -133,7 +418,7 @@ def login():
         password = request.form.get("password")
 
         admin = admins_col.find_one({"username": username})
-        if not admin or not check_password_hash(admin["password_hash"], password):
+        if not admin or not verify_password(admin, password):
             flash("Invalid credentials", "error")
             return redirect(url_for("login"))
 
@@ -141,6 +426,7 @@ def login():
         login_user(user)
 
         # FIX: remove any earlier “unauthorized” flashes so user sees only “Logged in”
+        # (e.g. from the dashboard's background /api/stats/class fetch being redirected)
         session.pop("_flashes", None)
         flash("Logged in", "success")
         return redirect(url_for("dashboard"))
@@ -159,29 +445,24 @@ def logout():
 @app.route("/admin")
 @admin_required
 def dashboard():
-    classes = students_col.distinct("class")
     class_stats = []
     total_collected = 0
     total_outstanding = 0
-    for cls in classes:
-        students = list(students_col.find({"class": cls}))
-        class_total = sum(s.get("total_fee", 0) for s in students)
-        collected = sum(
-            sum(p.get("amount", 0) for p in s.get("payments", []))
-            for s in students
-        )
-        outstanding = class_total - collected
+    for row in get_class_stats():
+        outstanding = row["class_total"] - row["collected"]
         class_stats.append({
-            "class": cls,
-            "class_total": class_total,
-            "collected": collected,
+            "class": row["_id"],
+            "class_total": row["class_total"],
+            "collected": row["collected"],
             "outstanding": outstanding,
-            "students_count": len(students)
+            "students_count": row["students_count"]
         })
-        total_collected += collected
+        total_collected += row["collected"]
         total_outstanding += outstanding
 
-    latest_students = list(students_col.find().sort("created_at", -1).limit(6))
+    latest_students = list(students_col.find(
+        {}, {"name": 1, "class": 1, "created_at": 1}
+    ).sort("created_at", -1).limit(6))
     return render_template("dashboard.html",
                            class_stats=class_stats,
                            total_collected=total_collected,
@@ -204,19 +485,21 @@ def students_list():
         if cls:
             query["class"] = cls
 
-    docs = list(students_col.find(query).sort("name", 1))
+    projection = {"name": 1, "class": 1, "contact": 1, "total_fee": 1, "paid_total": 1}
+    cursor = students_col.find(query, projection).sort("name", 1).batch_size(LIST_BATCH_SIZE)
 
-    students = []
-    for s in docs:
-        s["_id"] = str(s["_id"])
-        s["unpaid"] = calc_unpaid(s)
-        students.append(s)
+    # rows are prepared as the template iterates, not held in a list first
+    def prep(docs):
+        for s in docs:
+            s["_id"] = str(s["_id"])
+            s["unpaid"] = calc_unpaid(s)
+            yield s
 
-    classes = students_col.distinct("class")
+    classes = get_classes()
 
     return render_template(
         "students_list.html",
-        students=students,
+        students=prep(cursor),
         classes=classes,
         selected_class=None if search else cls,
         search_query=search
@@ -234,27 +517,26 @@ def add_student():
         contact = request.form.get("contact", "").strip()
         total_fee = float(request.form.get("total_fee") or 0)
 
-        # Duplicate check (exact match on normalized name + same class)
-        existing = students_col.find_one({
-            "name": name,
-            "class": cls
-        })
-
-        if existing:
-            flash("⚠ A student with this name already exists in this class!", "warning")
-            return redirect(url_for("add_student"))
-
         now = datetime.utcnow()
         student = {
             "name": name,
             "class": cls,
             "contact": contact,
             "total_fee": total_fee,
-            "payments": [],
+            "paid_total": 0,
             "created_at": now,
             "updated_at": now
         }
-        res = students_col.insert_one(student)
+        # Duplicates (same normalized name + same class) are rejected by the unique index
+        if not UNIQUE_STUDENT_INDEX and students_col.find_one({"name": name, "class": cls}):
+            flash("⚠ A student with this name already exists in this class!", "warning")
+            return redirect(url_for("add_student"))
+        try:
+            res = students_col.insert_one(student)
+        except DuplicateKeyError:
+            flash("⚠ A student with this name already exists in this class!", "warning")
+            return redirect(url_for("add_student"))
+        invalidate_stats()
         log_action("add_student", {"student_id": str(res.inserted_id), "name": name})
         flash("Student added", "success")
         return redirect(url_for("students_list"))
@@ -262,13 +544,85 @@ def add_student():
     return render_template("student_form.html", action="Add", student=None)
 
 
+@app.route("/admin/students/import", methods=["GET", "POST"])
+@admin_required
+def import_students():
+    """
+    Bulk add/update students from a CSV with columns: name, class, contact, total_fee
+    (header names are case-insensitive). Rows are matched on (normalized name, class);
+    existing students get their fee, and contact if one is given, updated. Rows with
+    no valid fee are skipped. Everything goes to MongoDB in one bulk_write.
+    """
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Please choose a CSV file", "error")
+            return redirect(url_for("import_students"))
+
+        try:
+            reader = csv.DictReader(io.StringIO(upload.read().decode("utf-8-sig")))
+            if reader.fieldnames:
+                reader.fieldnames = [(f or "").strip().lower() for f in reader.fieldnames]
+            rows = list(reader)
+        except (UnicodeDecodeError, csv.Error):
+            flash("Could not read the file, please upload a UTF-8 CSV", "error")
+            return redirect(url_for("import_students"))
+
+        now = datetime.utcnow()
+        ops = []
+        skipped = 0
+        for row in rows:
+            name = clean_name(row.get("name"))
+            cls = (row.get("class") or "").strip()
+            contact = (row.get("contact") or "").strip()
+            # a blank fee must not zero an existing student's fee
+            try:
+                total_fee = float((row.get("total_fee") or "").strip())
+            except ValueError:
+                total_fee = None
+            if not name or not cls or total_fee is None:
+                skipped += 1
+                continue
+
+            updates = {"total_fee": total_fee, "updated_at": now}
+            on_insert = {"paid_total": 0, "created_at": now}
+            # only overwrite a stored contact when the row actually has one
+            if contact:
+                updates["contact"] = contact
+            else:
+                on_insert["contact"] = ""
+            ops.append(UpdateOne(
+                {"name": name, "class": cls},
+                {"$set": updates, "$setOnInsert": on_insert},
+                upsert=True
+            ))
+
+        if not ops:
+            flash(f"Nothing to import ({skipped} rows skipped)", "warning")
+            return redirect(url_for("import_students"))
+
+        try:
+            result = students_col.bulk_write(ops, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            skipped += len(result["writeErrors"])
+
+        added, updated = result["nUpserted"], result["nModified"]
+        invalidate_stats()
+        log_action("import_students", {"added": added, "updated": updated, "skipped": skipped})
+        flash(f"Import done: {added} added, {updated} updated, {skipped} skipped", "success")
+        return redirect(url_for("students_list"))
+
+    return render_template("students_import.html")
+
+
 
 
 @app.route("/admin/student/<sid>/edit", methods=["GET", "POST"])
 @admin_required
 def edit_student(sid):
-    from bson import ObjectId
-    student = students_col.find_one({"_id": ObjectId(sid)})
+    oid = _oid(sid)
+    student = students_col.find_one({"_id": oid})
     if not student:
         flash("Student not found", "error")
         return redirect(url_for("students_list"))
@@ -280,29 +634,32 @@ def edit_student(sid):
         contact = request.form.get("contact", "").strip()
         total_fee = float(request.form.get("total_fee") or 0)
 
-        # Optional: check duplicates when editing (if name/class changed)
-        existing = students_col.find_one({
+        if not UNIQUE_STUDENT_INDEX and students_col.find_one({
             "name": name,
             "class": cls,
-            "_id": {"$ne": ObjectId(sid)}   # ignore the same document
-        })
-        if existing:
+            "_id": {"$ne": oid}   # ignore the same document
+        }):
             flash("⚠ Another student with this name already exists in this class!", "warning")
             return redirect(url_for("edit_student", sid=sid))
-
-        students_col.update_one({"_id": ObjectId(sid)}, {"$set": {
-            "name": name,
-            "class": cls,
-            "contact": contact,
-            "total_fee": total_fee,
-            "updated_at": datetime.utcnow()
-        }})
+        try:
+            students_col.update_one({"_id": oid}, {"$set": {
+                "name": name,
+                "class": cls,
+                "contact": contact,
+                "total_fee": total_fee,
+                "updated_at": datetime.utcnow()
+            }})
+        except DuplicateKeyError:
+            flash("⚠ Another student with this name already exists in this class!", "warning")
+            return redirect(url_for("edit_student", sid=sid))
+        invalidate_stats()
         log_action("edit_student", {"student_id": sid})
         flash("Student updated", "success")
         return redirect(url_for("students_list"))
 
     # prepare student for display
     student["_id"] = str(student.get("_id"))
+    student["payments"] = list(payments_col.find({"student_id": oid}).sort("date", 1))
     return render_template("student_form.html", action="Edit", student=student)
 
 
@@ -310,7 +667,10 @@ def edit_student(sid):
 @app.route("/admin/student/<sid>/delete", methods=["POST"])
 @admin_required
 def delete_student(sid):
-    students_col.delete_one({"_id": ObjectId(sid)})
+    oid = _oid(sid)
+    students_col.delete_one({"_id": oid})
+    payments_col.delete_many({"student_id": oid})
+    invalidate_stats()
     log_action("delete_student", {"student_id": sid})
     flash("Student deleted", "success")
     return redirect(url_for("students_list"))
@@ -319,21 +679,35 @@ def delete_student(sid):
 @app.route("/admin/student/<sid>/add_payment", methods=["POST"])
 @admin_required
 def add_payment(sid):
+    oid = _oid(sid)
     try:
         amount = float(request.form.get("amount") or 0)
     except ValueError:
         amount = 0
     note = request.form.get("note")
-    payment = {
+    # Record the payment first, then count it on the student; undo the insert if the
+    # student is gone (e.g. just deleted) or the update fails, so paid_total never
+    # includes money without a payment record
+    payment_id = payments_col.insert_one({
+        "student_id": oid,
         "amount": amount,
         "date": datetime.utcnow(),
         "note": note
-    }
-    students_col.update_one(
-        {"_id": ObjectId(sid)},
-        {"$push": {"payments": payment},
-         "$set": {"updated_at": datetime.utcnow()}}
-    )
+    }).inserted_id
+    try:
+        res = students_col.update_one(
+            {"_id": oid},
+            {"$inc": {"paid_total": amount},
+             "$set": {"updated_at": datetime.utcnow()}}
+        )
+    except PyMongoError:
+        payments_col.delete_one({"_id": payment_id})
+        raise
+    if res.matched_count == 0:
+        payments_col.delete_one({"_id": payment_id})
+        flash("Student not found", "error")
+        return redirect(url_for("students_list"))
+    invalidate_stats()
     log_action("add_payment", {"student_id": sid, "amount": amount})
     flash("Payment recorded", "success")
     return redirect(url_for("edit_student", sid=sid))
@@ -342,70 +716,43 @@ def add_payment(sid):
 @app.route("/api/stats/class")
 @admin_required
 def api_class_stats():
-    classes = students_col.distinct("class")
     labels = []
     collected = []
     outstanding = []
-    for cls in classes:
-        students = list(students_col.find({"class": cls}))
-        coll = sum(sum(p.get("amount", 0) for p in s.get("payments", [])) for s in students)
-        tot = sum(s.get("total_fee", 0) for s in students)
-        out = tot - coll
-        labels.append(cls)
-        collected.append(coll)
-        outstanding.append(out)
+    for row in get_class_stats():
+        labels.append(row["_id"])
+        collected.append(row["collected"])
+        outstanding.append(row["class_total"] - row["collected"])
     return jsonify({"labels": labels, "collected": collected, "outstanding": outstanding})
 
 
 @app.route("/admin/unpaid")
 @admin_required
 def unpaid():
-    docs = list(students_col.find())
-    unpaid_list = []
-    for s in docs:
-        unpaid_amt = calc_unpaid(s)
-        if unpaid_amt > 0:
-            unpaid_list.append({
-                "_id": str(s["_id"]),
-                "name": s.get("name"),
-                "class": s.get("class"),
-                "unpaid": unpaid_amt
-            })
+    pipeline = [
+        {"$match": {"$expr": {"$gt": ["$total_fee", "$paid_total"]}}},
+        {"$project": {
+            "name": 1,
+            "class": 1,
+            "unpaid": {"$subtract": ["$total_fee", "$paid_total"]}
+        }}
+    ]
+    unpaid_list = students_col.aggregate(pipeline, batchSize=LIST_BATCH_SIZE)
     return render_template("unpaid.html", unpaid_list=unpaid_list)
 
 
 @app.route("/admin/logs")
 @admin_required
 def logs():
-    docs = list(logs_col.find().sort("at", -1).limit(200))
-    # convert ObjectId and datetime to string for template safety
-    for l in docs:
-        l["at"] = l.get("at").strftime("%Y-%m-%d %H:%M:%S")
-        l["details"] = str(l.get("details"))
-    return render_template("logs.html", logs=docs)
+    cursor = logs_col.find(
+        {}, {"action": 1, "details": 1, "by": 1, "at": 1}
+    ).sort("at", -1).limit(200).batch_size(LIST_BATCH_SIZE)
+    return render_template("logs.html", logs=cursor)
 
 @app.route("/admin/summary")
 @admin_required
 def summary():
-    # Total students
-    total_students = students_col.count_documents({})
-
-    # Class-wise counts
-    pipeline = [
-        {"$group": {"_id": "$class", "count": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ]
-    class_counts = list(students_col.aggregate(pipeline))
-
-    # Free students (monthly_fee = 0)
-    free_students = students_col.count_documents({"total_fee": 0})
-
-    return render_template(
-        "summary.html",
-        total_students=total_students,
-        class_counts=class_counts,
-        free_students=free_students
-    )
+    return render_template("summary.html", **get_summary_stats())
 
 @app.route("/admin/analytics/monthly")
 @admin_required
@@ -420,28 +767,23 @@ def monthly_analytics():
 
     month_data = defaultdict(lambda: {"collected": 0, "expected": 0})
 
-    students = list(students_col.find())
+    fees = {s["_id"]: s.get("total_fee", 0) for s in students_col.find({}, {"total_fee": 1})}
+    paid_months = set()
 
-    for s in students:
-        monthly_fee = s.get("total_fee", 0)
-
-        # Expected fee: he should pay every month
-        for pay in s.get("payments", []):
-            month = pay.get("month")   # example: "2025-01"
-            amount = pay.get("amount", 0)
-
-            if not month:
-                continue
+    for pay in payments_col.find({"month": {"$exists": True}}, {"student_id": 1, "month": 1, "amount": 1}):
+        month = pay.get("month")   # example: "2025-01"
+        amount = pay.get("amount", 0)
 
-            # Add collected amount
-            month_data[month]["collected"] += amount
+        if not month:
+            continue
 
-        # Add expected fee for ALL months that appear in DB (or we can generate months dynamically)
-        # We check payment history of student
-        paid_months = {p.get("month") for p in s.get("payments", [])}
+        # Add collected amount
+        month_data[month]["collected"] += amount
+        paid_months.add((pay["student_id"], month))
 
-        for m in paid_months:
-            month_data[m]["expected"] += monthly_fee
+    # Expected fee: he should pay every month he has a payment recorded for
+    for student_id, m in paid_months:
+        month_data[m]["expected"] += fees.get(student_id, 0)
 
     # Sort months nicely
     sorted_months = sorted(month_data.keys())